@@ -1,20 +1,38 @@
-from typing import List, Tuple
+from typing import List, Tuple, Optional
+from collections import OrderedDict
+import aiohttp
+import asyncio
 import dataclasses
 import datetime
 import itertools
+import jsonlines
+import mmap
 import numpy as np
 import openai
+import os
+import pickle
 import regex as re
 import requests
+import threading
 import time
 
+# faiss is optional, and only used to read a prebuilt index: without one,
+# LocalIndex scans the memory-mapped embeddings with numpy instead.
+try:
+    import faiss
+except ImportError:
+    faiss = None
+
 # ---------------------------------- constants ---------------------------------
 
 EMBEDDING_MODEL = "text-embedding-ada-002"
+LEN_EMBEDDINGS = 1536
+
+QUERY_EMBEDDING_CACHE_SIZE = 4096
 
 # ------------------------------------ types -----------------------------------
 
-@dataclasses.dataclass
+@dataclasses.dataclass(slots=True)
 class Block:
     title: str
     author: str
@@ -22,7 +40,138 @@ class Block:
     url: str
     tags: str
     text: str
-    
+
+    # A flat dict for serializing; unlike dataclasses.asdict, this doesn't deep-copy every field.
+    def to_dict(self) -> dict:
+        return {"title": self.title, "author": self.author, "date": self.date, "url": self.url, "tags": self.tags, "text": self.text}
+
+# In-process alternative to the Pinecone index, built from the dataset dict
+# written by Dataset.save_data (and downloaded by dataset_dl.py) or from an
+# export. Searches a prebuilt FAISS index if there is one, otherwise scans the
+# embeddings directly. The scan reads the same memory-mapped file in every
+# worker, whereas building an index at startup would copy the whole matrix
+# into each worker's memory.
+class LocalIndex:
+
+    def __init__(self, blocks: List[Block], index = None, embeddings: Optional[np.ndarray] = None):
+        assert (index is None) != (embeddings is None), "need exactly one of a FAISS index or an embeddings matrix"
+        self.blocks = blocks
+        self.index = index
+        self.embeddings = embeddings # unit-length rows, float32 so `@` dispatches to BLAS sgemv
+
+    @classmethod
+    def from_dataset_dict(cls, dataset_path: str, index_path: Optional[str] = None) -> "LocalIndex":
+
+        with open(dataset_path, 'rb') as f:
+            dataset = pickle.load(f)
+
+        blocks = []
+        for text, metadata_index in zip(dataset['embedding_strings'], dataset['embeddings_metadata_index']):
+            title, author, date, url, tags = dataset['metadata'][metadata_index]
+            blocks.append(Block(title, author, date, url, tags, strip_block(text)))
+
+        index = read_prebuilt_index(index_path, len(blocks))
+        if index is not None: return cls(blocks, index=index)
+
+        # Normalize once here, so that cosine similarity is a plain dot product per query.
+        return cls.from_normalized(blocks, normalize_rows(np.array(dataset['embeddings'], dtype=np.float32)))
+
+    # Load the <base>.npy / <base>.meta.jsonl pair written by Dataset.save or
+    # Dataset.stream_embeddings.
+    @classmethod
+    def from_export(cls, base: str, index_path: Optional[str] = None) -> "LocalIndex":
+
+        embeddings_path, metadata_path = export_paths(base)
+
+        blocks = []
+        with jsonlines.open(metadata_path, 'r') as reader:
+            for record in reader:
+                record['text'] = strip_block(record['text'])
+                blocks.append(Block(**record))
+
+        index = read_prebuilt_index(index_path, len(blocks))
+        if index is not None: return cls(blocks, index=index)
+
+        return cls.from_normalized(blocks, load_normalized_embeddings(embeddings_path))
+
+    @classmethod
+    def from_normalized(cls, blocks: List[Block], embeddings: np.ndarray) -> "LocalIndex":
+        assert len(blocks) == embeddings.shape[0], f"{len(blocks)} blocks but {embeddings.shape[0]} embeddings"
+        return cls(blocks, embeddings=embeddings)
+
+    # Inner product on unit vectors, i.e. cosine similarity.
+    def search(self, query_embedding: np.ndarray, k: int) -> List[Block]:
+        # clamp here, so every backend agrees (faiss asserts k > 0, argpartition would return everything)
+        k = min(k, len(self.blocks))
+        if k <= 0: return []
+
+        query = normalize_rows(np.array(query_embedding, dtype=np.float32).reshape(1, -1))
+
+        if self.index is not None:
+            _, indices = self.index.search(query, k)
+            return [self.blocks[i] for i in indices[0] if i != -1]
+
+        scores = self.embeddings @ query[0]
+        top_k = np.argpartition(scores, -k)[-k:] # no need to sort everything, just the top k
+        top_k = top_k[np.argsort(-scores[top_k])]
+        return [self.blocks[i] for i in top_k]
+
+
+# Read a prebuilt index (see Dataset.save_faiss_index), if we have one.
+# Memory-mapped where the index type supports it, so workers share its pages.
+def read_prebuilt_index(index_path: Optional[str], num_blocks: int):
+    if faiss is None or index_path is None or not os.path.exists(index_path): return None
+    index = faiss.read_index(index_path, faiss.IO_FLAG_MMAP | getattr(faiss, 'IO_FLAG_MMAP_IFC', 0))
+    assert index.ntotal == num_blocks, f"{index_path} has {index.ntotal} vectors but the dataset has {num_blocks} blocks; rebuild it"
+    return index
+
+
+# Memory-map the unit-length float32 copy of the .npy at `path`, which
+# Dataset.save (or stream_embeddings) writes next to it as
+# <base>.normalized.f32.npy. Every worker maps the same file, so they share one
+# copy in the page cache, and startup doesn't read the whole matrix. Building
+# it here would make every worker normalize the whole matrix in memory, so a
+# missing or stale copy is an error instead.
+def load_normalized_embeddings(path: str) -> np.ndarray:
+    normalized_path = f"{path.removesuffix('.npy')}.normalized.f32.npy"
+
+    if not os.path.exists(normalized_path) or os.stat(normalized_path).st_mtime_ns < os.stat(path).st_mtime_ns:
+        raise FileNotFoundError(f"{normalized_path} is missing or older than {path}; write it with Dataset.save or Dataset.load_embeddings")
+
+    embeddings = mmap_npy(normalized_path)
+    assert embeddings.dtype == np.float32, f"{normalized_path} should be float32, not {embeddings.dtype}"
+    return embeddings
+
+
+# Read-only view of the .npy at `path`, backed by our own mmap (rather than
+# np.load's) so that we can advise the kernel on it.
+def mmap_npy(path: str) -> np.ndarray:
+    with open(path, 'rb') as f:
+        version = np.lib.format.read_magic(f)
+        read_header = np.lib.format.read_array_header_1_0 if version == (1, 0) else np.lib.format.read_array_header_2_0
+        shape, fortran_order, dtype = read_header(f)
+        offset = f.tell()
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) # stays valid after the file is closed
+
+    # every search scans the whole matrix front to back, so have the kernel read ahead aggressively
+    if hasattr(mmap, 'MADV_SEQUENTIAL'): buffer.madvise(mmap.MADV_SEQUENTIAL)
+
+    return np.ndarray(shape, dtype=dtype, buffer=buffer, offset=offset, order='F' if fortran_order else 'C')
+
+
+# The embeddings and metadata files of the export at `base`.
+def export_paths(base: str) -> Tuple[str, str]:
+    # appended as strings, like every other suffix on DATASET_PATH, so a dotted base keeps its name
+    return f"{base}.npy", f"{base}.meta.jsonl"
+
+
+# Scale each row to unit length (leaving all-zero rows alone).
+def normalize_rows(embeddings: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    embeddings /= norms
+    return embeddings
+
 # ------------------------------------------------------------------------------
 
 # Get the embedding for a given text. The function will retry with exponential backoff if the API rate limit is reached, up to 4 times.
@@ -46,60 +195,165 @@ def get_embedding(text: str) -> np.ndarray:
             time.sleep(min(max_wait_time, 2 ** attempt))
 
 
-# Get the k blocks most semantically similar to the query using Pinecone.
-def get_top_k_blocks(index, user_query: str, k: int) -> List[Block]:
+# One connection-pooled session shared by all async OpenAI calls, opened and
+# closed along with the app (see main.py).
+AIOSESSION: Optional[aiohttp.ClientSession] = None
+
+async def open_aiosession():
+    global AIOSESSION
+    AIOSESSION = aiohttp.ClientSession()
+
+async def close_aiosession():
+    global AIOSESSION
+    if AIOSESSION is not None: await AIOSESSION.close()
+    AIOSESSION = None
 
-    # Default to querying embeddings from live website if pinecone url not
-    # present in .env
-    #
-    # This helps people getting started developing or messing around with the
-    # site, since setting up a vector DB with the embeddings is by far the
-    # hardest part for those not already on the team.
-
-    if index is None:
-
-        print('Pinecone index not found, performing semantic search on alignmentsearch-api.up.railway.app endpoint.')
-        response = requests.post(
-            "https://alignmentsearch-api.up.railway.app/semantic",
-            json = {
-                "query": user_query,
-                "k": k
-            }
-        )
 
-        return [Block(**block) for block in response.json()]
+# Same as get_embedding, but awaitable, so the event loop keeps serving other
+# requests while OpenAI computes the embedding.
+async def get_embedding_async(text: str) -> np.ndarray:
+
+    max_retries = 4
+    max_wait_time = 10
+    attempt = 0
+
+    # openai-python reads the session from a context variable, which each request's task has its own copy of
+    if AIOSESSION is not None: openai.aiosession.set(AIOSESSION)
+
+    while True:
+        try:
+            result = await openai.Embedding.acreate(model=EMBEDDING_MODEL, input=text)
+            return result["data"][0]["embedding"]
+
+        except openai.error.RateLimitError as e:
+
+            attempt += 1
+
+            if attempt > max_retries: raise e
+
+            await asyncio.sleep(min(max_wait_time, 2 ** attempt))
+
+
+# Query embeddings are cached by normalized query, so retries and repeated
+# questions don't cost an API call. Shared between the sync (/chat, which runs
+# in a thread) and async (/semantic) paths, hence the lock.
+QUERY_EMBEDDING_CACHE: "OrderedDict[str, np.ndarray]" = OrderedDict()
+QUERY_EMBEDDING_CACHE_LOCK = threading.Lock()
+
+def normalize_query(query: str) -> str:
+    return query.strip().lower()
+
+def get_cached_query_embedding(query: str) -> Optional[np.ndarray]:
+    with QUERY_EMBEDDING_CACHE_LOCK:
+        embedding = QUERY_EMBEDDING_CACHE.get(query)
+        if embedding is not None: QUERY_EMBEDDING_CACHE.move_to_end(query)
+        return embedding
+
+def cache_query_embedding(query: str, embedding) -> np.ndarray:
+    embedding = np.array(embedding, dtype=np.float32)
+    embedding.flags.writeable = False # shared between callers via the cache
+    with QUERY_EMBEDDING_CACHE_LOCK:
+        QUERY_EMBEDDING_CACHE[query] = embedding
+        QUERY_EMBEDDING_CACHE.move_to_end(query)
+        if len(QUERY_EMBEDDING_CACHE) > QUERY_EMBEDDING_CACHE_SIZE: QUERY_EMBEDDING_CACHE.popitem(last=False)
+    return embedding
+
+def get_query_embedding(query: str) -> np.ndarray:
+    query = normalize_query(query)
+    embedding = get_cached_query_embedding(query)
+    if embedding is None: embedding = cache_query_embedding(query, get_embedding(query))
+    return embedding
+
+async def get_query_embedding_async(query: str) -> np.ndarray:
+    query = normalize_query(query)
+    embedding = get_cached_query_embedding(query)
+    if embedding is None: embedding = cache_query_embedding(query, await get_embedding_async(query))
+    return embedding
+
+
+# Default to querying embeddings from live website if pinecone url not
+# present in .env
+#
+# This helps people getting started developing or messing around with the
+# site, since setting up a vector DB with the embeddings is by far the
+# hardest part for those not already on the team.
+def get_top_k_blocks_remote(user_query: str, k: int) -> List[Block]:
+
+    print('Pinecone index not found, performing semantic search on alignmentsearch-api.up.railway.app endpoint.')
+    response = requests.post(
+        "https://alignmentsearch-api.up.railway.app/semantic",
+        json = {
+            "query": user_query,
+            "k": k
+        }
+    )
+
+    return [Block(**block) for block in response.json()]
+
+
+# Get the k blocks most semantically similar to the query using Pinecone (or a LocalIndex).
+def get_top_k_blocks(index, user_query: str, k: int) -> List[Block]:
+
+    if index is None: return get_top_k_blocks_remote(user_query, k)
 
     # print time
     t = time.time()
 
     # Get the embedding for the query.
-    query_embedding = get_embedding(user_query)
+    query_embedding = get_query_embedding(user_query)
+
+    print("Time to get embedding: ", time.time() - t)
+
+    return search_blocks(index, query_embedding, k)
+
+
+# Same as get_top_k_blocks, but the embedding call is awaited and the blocking
+# search runs on a worker thread, so neither holds up the event loop.
+async def get_top_k_blocks_async(index, user_query: str, k: int) -> List[Block]:
+
+    if index is None: return await asyncio.to_thread(get_top_k_blocks_remote, user_query, k)
+
+    t = time.time()
+
+    query_embedding = await get_query_embedding_async(user_query)
+
+    print("Time to get embedding: ", time.time() - t)
+
+    return await asyncio.to_thread(search_blocks, index, query_embedding, k)
+
+
+# Search Pinecone (or a LocalIndex) for the blocks closest to an embedding,
+# combining blocks that come from the same source.
+def search_blocks(index, query_embedding: np.ndarray, k: int) -> List[Block]:
 
     t1 = time.time()
-    print("Time to get embedding: ", t1 - t)
-
-    query_response = index.query(
-        namespace="alignment-search",  # ugly, sorry
-        top_k=k,
-        include_values=False,
-        include_metadata=True,
-        vector=query_embedding
-    )
-    blocks = []
-    for match in query_response['matches']:
 
-        date = match['metadata']['date']
+    if isinstance(index, LocalIndex):
+        blocks = index.search(query_embedding, k)
+
+    else:
+        query_response = index.query(
+            namespace="alignment-search",  # ugly, sorry
+            top_k=k,
+            include_values=False,
+            include_metadata=True,
+            vector=query_embedding.tolist()
+        )
+        blocks = []
+        for match in query_response['matches']:
+
+            date = match['metadata']['date']
 
-        if type(date) == datetime.date: date = date.strftime("%Y-%m-%d") # iso8601
+            if type(date) == datetime.date: date = date.strftime("%Y-%m-%d") # iso8601
 
-        blocks.append(Block(
-            title = match['metadata']['title'],
-            author = match['metadata']['author'],
-            date = date,
-            url = match['metadata']['url'],
-            tags = match['metadata']['tags'],
-            text = match['metadata']['text']
-        ))
+            blocks.append(Block(
+                title = match['metadata']['title'],
+                author = match['metadata']['author'],
+                date = date,
+                url = match['metadata']['url'],
+                tags = match['metadata']['tags'],
+                text = match['metadata']['text']
+            ))
 
     t2 = time.time()
 
@@ -0,0 +1,13 @@
+# Loaded with `hypercorn main:app --config file:hypercorn.conf.py` (see nixpacks.toml).
+#
+# Each worker runs an event loop, so a single worker can have many requests
+# waiting on OpenAI at once. A few workers spread the CPU work (JSON, searches),
+# but each one loads its own index and semantic cache, so the count is fixed
+# rather than one per host CPU (which also ignores container CPU limits).
+# Override it with WEB_CONCURRENCY.
+
+import os
+
+bind = [f"0.0.0.0:{os.environ.get('PORT', '3000')}"]
+workers = int(os.environ.get('WEB_CONCURRENCY') or 4)
+worker_class = "uvloop"
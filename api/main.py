@@ -1,8 +1,10 @@
-from flask import Flask, jsonify, request, Response
-from flask_cors import CORS, cross_origin
-from get_blocks import get_top_k_blocks
+from quart import Quart, request, Response
+from quart.utils import run_sync_iterable
+from quart_cors import cors
+from get_blocks import get_top_k_blocks_async, get_query_embedding_async, open_aiosession, close_aiosession, LocalIndex, LEN_EMBEDDINGS, export_paths, faiss
+from semantic_cache import SemanticCache
 from chat import talk_to_robot
-import dataclasses
+import orjson
 import os
 import openai
 import pinecone
@@ -21,7 +23,9 @@ else:
 OPENAI_API_KEY   = os.environ.get('OPENAI_API_KEY')
 PINECONE_API_KEY = os.environ.get('PINECONE_API_KEY')
 LOGGING_URL      = os.environ.get('LOGGING_URL')
-PINECONE_INDEX   = None
+DATASET_PATH     = os.environ.get('DATASET_PATH') or 'dataset'
+FAISS_INDEX_PATH = os.environ.get('FAISS_INDEX_PATH') or DATASET_PATH + '.faiss'
+SEARCH_INDEX     = None
 
 openai.api_key = OPENAI_API_KEY # non-optional
 
@@ -33,7 +37,19 @@ if PINECONE_API_KEY is not None and PINECONE_API_KEY != "":
         environment = "us-east1-gcp",
     )
 
-    PINECONE_INDEX = pinecone.Index(index_name="alignment-search")
+    SEARCH_INDEX = pinecone.Index(index_name="alignment-search")
+
+# Otherwise search in-process if we have the dataset, either as exported by
+# Dataset.save or as downloaded by dataset_dl.py.
+elif os.path.exists(export_paths(DATASET_PATH)[0]) or os.path.exists(DATASET_PATH + '.pkl'):
+
+    if os.path.exists(export_paths(DATASET_PATH)[0]):
+        SEARCH_INDEX = LocalIndex.from_export(DATASET_PATH, FAISS_INDEX_PATH)
+    else:
+        SEARCH_INDEX = LocalIndex.from_dataset_dict(DATASET_PATH + '.pkl', FAISS_INDEX_PATH)
+
+    # searches run one per request on asyncio's thread pool, so each should stay single-threaded
+    if faiss is not None: faiss.omp_set_num_threads(1)
 
 # log something only if the logging url is set
 def log(*args, end="\n"): 
@@ -48,9 +64,16 @@ def log(*args, end="\n"):
 
 # ---------------------------------- web setup ---------------------------------
 
-app = Flask(__name__)
-cors = CORS(app)
-app.config['CORS_HEADERS'] = 'Content-Type'
+app = Quart(__name__)
+app = cors(app)
+
+@app.before_serving
+async def startup():
+    await open_aiosession()
+
+@app.after_serving
+async def shutdown():
+    await close_aiosession()
 
 # ---------------------------------- sse stuff ---------------------------------
 
@@ -60,13 +83,31 @@ def stream(src):
 
 # ------------------------------- semantic search ------------------------------
 
+SEMANTIC_CACHE = SemanticCache(LEN_EMBEDDINGS)
+
+MAX_SEMANTIC_K = 100
+
 
 @app.route('/semantic', methods=['POST'])
-@cross_origin()
-def semantic():
-    query = request.json['query']
-    k = request.json['k'] if 'k' in request.json else 20
-    return jsonify([dataclasses.asdict(block) for block in get_top_k_blocks(PINECONE_INDEX, query, k)])
+async def semantic():
+    body = await request.get_json()
+    query = body['query']
+    k = body['k'] if 'k' in body else 20
+
+    if type(k) != int or not 1 <= k <= MAX_SEMANTIC_K:
+        return Response(orjson.dumps({"error": f"k must be an integer from 1 to {MAX_SEMANTIC_K}"}), status=400, mimetype='application/json')
+
+    # without an index we just proxy the online API, so there's no embedding to cache on
+    if SEARCH_INDEX is None:
+        return Response(orjson.dumps([block.to_dict() for block in await get_top_k_blocks_async(SEARCH_INDEX, query, k)]), mimetype='application/json')
+
+    query_embedding = await get_query_embedding_async(query)
+    response = SEMANTIC_CACHE.get(query_embedding, k)
+    if response is None:
+        response = orjson.dumps([block.to_dict() for block in await get_top_k_blocks_async(SEARCH_INDEX, query, k)])
+        SEMANTIC_CACHE.put(query_embedding, k, response)
+
+    return Response(response, mimetype='application/json')
 
 
 
@@ -74,17 +115,19 @@ def semantic():
 
 
 @app.route('/chat', methods=['POST'])
-@cross_origin()
-def chat():
+async def chat():
 
-    query = request.json['query']
-    history = request.json['history']
+    body = await request.get_json()
+    query = body['query']
+    history = body['history']
 
-    return Response(stream(talk_to_robot(PINECONE_INDEX, query, history, log = log)), mimetype='text/event-stream')
+    # talk_to_robot is a blocking generator (it streams from OpenAI), so it is iterated on a worker thread
+    return Response(run_sync_iterable(stream(talk_to_robot(SEARCH_INDEX, query, history, log = log))), mimetype='text/event-stream')
 
 
 # ------------------------------------------------------------------------------
 
 
 if __name__ == '__main__':
-    app.run(debug=True, port=3000)
+    # local development only; in production we run under hypercorn (see hypercorn.conf.py)
+    app.run(debug=os.environ.get('QUART_ENV') == 'development', port=3000)
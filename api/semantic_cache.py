@@ -0,0 +1,56 @@
+from typing import List, Optional
+import numpy as np
+
+# ------------------------------------------------------------------------------
+
+# Caches serialized /semantic responses keyed by query embedding, so that
+# paraphrases of a recent query ("what is alignment?" vs "What's alignment")
+# are answered without searching the index again.
+#
+# At this size a brute-force scan over the cached embeddings is cheaper than
+# maintaining an index, and it makes LRU eviction a plain slot overwrite.
+#
+# Only used from the event loop, so it needs no locking.
+class SemanticCache:
+
+    def __init__(self, dim: int, max_size: int = 1024, threshold: float = 0.97):
+        self.threshold = threshold
+        self.embeddings = np.zeros((max_size, dim), dtype=np.float32)
+        self.ks = np.zeros(max_size, dtype=np.int64)
+        self.last_used = np.zeros(max_size, dtype=np.int64)
+        self.values: List[Optional[bytes]] = [None] * max_size
+        self.size = 0
+        self.clock = 0
+
+    # Return the cached value for the most similar query with the same k, if
+    # it is at least `threshold` similar.
+    def get(self, embedding: np.ndarray, k: int) -> Optional[bytes]:
+        if self.size == 0: return None
+
+        scores = self.embeddings[:self.size] @ normalize(embedding)
+        scores[self.ks[:self.size] != k] = -np.inf
+        best = int(np.argmax(scores))
+        if scores[best] < self.threshold: return None
+
+        self.clock += 1
+        self.last_used[best] = self.clock
+        return self.values[best]
+
+    def put(self, embedding: np.ndarray, k: int, value: bytes):
+        if self.size < len(self.values):
+            slot = self.size
+            self.size += 1
+        else:
+            slot = int(np.argmin(self.last_used)) # evict the least recently used entry
+
+        self.clock += 1
+        self.embeddings[slot] = normalize(embedding)
+        self.ks[slot] = k
+        self.last_used[slot] = self.clock
+        self.values[slot] = value
+
+
+def normalize(embedding: np.ndarray) -> np.ndarray:
+    embedding = np.asarray(embedding, dtype=np.float32)
+    norm = np.linalg.norm(embedding)
+    return embedding / norm if norm > 0 else embedding
@@ -1,16 +1,22 @@
 import jsonlines
 import numpy as np
-from typing import List, Dict, Tuple, DefaultDict, Any
+from typing import List, Dict, Tuple, DefaultDict, Any, Iterator, Callable, Optional
 from collections import defaultdict
 import time
 import random
 import pickle
 import os
-import concurrent.futures
+import asyncio
+import aiohttp
+import contextlib
+import re
 from pathlib import Path
 from tqdm.auto import tqdm
 from dateutil.parser import parse, ParserError
 import openai
+import tiktoken
+import hashlib
+import diskcache
 
 try:
     import config
@@ -19,12 +25,42 @@ except ImportError:
     openai.api_key = os.environ.get('OPENAI_API_KEY')
 
 
-from .settings import PATH_TO_RAW_DATA, PATH_TO_DATASET_PKL, PATH_TO_DATASET_DICT_PKL, EMBEDDING_MODEL, LEN_EMBEDDINGS
+from .settings import PATH_TO_RAW_DATA, PATH_TO_DATASET_EXPORT, PATH_TO_DATASET_DICT_PKL, PATH_TO_EMBEDDING_CACHE, EMBEDDING_MODEL, LEN_EMBEDDINGS
 
-from .text_splitter import TokenSplitter, split_into_sentences
+from .text_splitter import TokenSplitter
 
 
 
+# The embeddings endpoint takes a list of inputs per request, so we pack blocks
+# into batches bounded both by count and by total tokens.
+MAX_TEXTS_PER_EMBEDDING_BATCH = 256
+MAX_TOKENS_PER_EMBEDDING_BATCH = 250_000
+MAX_TOKENS_PER_EMBEDDING_INPUT = 8191
+
+# A failed batch goes back in the queue (and through the rate limiter) up to this many times in total. After a 429,
+# no new requests are sent for a while, so the quota can recover.
+MAX_ATTEMPTS_PER_EMBEDDING_BATCH = 6
+SECONDS_TO_PAUSE_AFTER_RATE_LIMIT_ERROR = 15
+
+# Errors worth retrying. Anything else (a bad key, an invalid request) would fail the same way every time.
+TRANSIENT_EMBEDDING_ERRORS = (
+    openai.error.RateLimitError,
+    openai.error.Timeout,
+    openai.error.TryAgain,
+    openai.error.APIConnectionError,
+    openai.error.ServiceUnavailableError,
+)
+
+# OpenAI returns ~7 significant digits and cosine similarity is robust to fp16,
+# so we store embeddings at a quarter of numpy's default float64 size.
+EMBEDDING_DTYPE = np.float16
+
+ENCODER = tiktoken.encoding_for_model(EMBEDDING_MODEL)
+
+# Only used to count sentences for the dataset stats, where an approximation is fine.
+SENTENCE_END = re.compile(r'[.!?]+(?:\s+|$)')
+
+
 error_count_dict = {
     "Entry has no source.": 0,
     "Entry has no title.": 0,
@@ -34,6 +70,57 @@ error_count_dict = {
 }
 
 
+# Dict describing the proportion of each source we want:
+# E.g.: {'arxiv': 0.5, 'youtube': 0.5, 'lesswrong': 1.0}
+DESIRED_SOURCE_PROPORTIONS = {
+    "https://aipulse.org": 1,
+    "ebook": 0,
+    "https://qualiacomputing.com": 0.02,
+    "alignment forum": .7,
+    "lesswrong": .5,
+    "manual": 1,
+    "arxiv": 0.1,
+    "https://deepmindsafetyresearch.medium.com/": 1,
+    "waitbutwhy.com": 1,
+    "GitHub": 1,
+    "https://aiimpacts.org": 0.2,
+    "arbital.com": 0.2,
+    "carado.moe": 0.3,
+    "nonarxiv_papers": 0.1,
+    "https://vkrakovna.wordpress.com": .5,
+    "https://jsteinhardt.wordpress.com": .5,
+    "audio-transcripts": 0.2,
+    "https://intelligence.org": .1,
+    "youtube": 0.07,
+    "reports": 0.4,
+    "https://aisafety.camp": 1,
+    "curriculum": 1,
+    "https://www.yudkowsky.net": 0.2,
+    "distill": 1,
+    "Cold Takes": 0.5,
+    "printouts": 1,
+    "gwern.net": 1,
+    "generative.ink": 1,
+    "greaterwrong.com": 0.2
+}
+
+# Entries without a 'source' field are attributed from their 'url' (or 'article_url').
+EXACT_URL_TO_SOURCE = {
+    "https://www.cold-takes.com/": "Cold Takes",
+    "https://generative.ink/posts/": "generative.ink",
+    "https://www.gwern.net": "gwern.net",
+}
+PREFIX_URL_TO_SOURCE = (
+    ("https://greaterwrong.com", "greaterwrong.com"),
+)
+
+# Keys to look for each field under, in order of preference. Dates are truncated to the given length.
+TITLE_KEYS = ('title', 'book_title')
+AUTHOR_KEYS = ('author', 'authors')
+DATE_KEYS = (('date_published', 10), ('published', 16))
+URL_KEYS = ('link', 'url', 'doi')
+
+
 class MissingDataException(Exception):
     pass
 
@@ -43,6 +130,8 @@ class Dataset:
             jsonl_data_path: str = PATH_TO_RAW_DATA,  # Path to the dataset .jsonl file.
             custom_sources: List[str] = None,  # List of sources to include, like "alignment forum", "lesswrong", "arxiv",etc.
             rate_limit_per_minute: int = 3_500,  # Rate limit for the OpenAI API.
+            tokens_per_minute: int = 350_000,  # Token rate limit for the OpenAI API.
+            max_concurrent_requests: int = 64,  # Maximum number of embedding requests in flight at once.
             min_tokens_per_block: int = 300, # Minimum number of tokens per block.
             max_tokens_per_block: int = 400, # Maximum number of tokens per block.
             fraction_of_articles_to_use: float = 1.0,  # Fraction of articles to use. If 1.0, use all articles.
@@ -50,7 +139,8 @@ class Dataset:
         self.jsonl_data_path = jsonl_data_path
         self.custom_sources = custom_sources
         self.rate_limit_per_minute = rate_limit_per_minute
-        self.delay_in_seconds = 60.0 / self.rate_limit_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.max_concurrent_requests = max_concurrent_requests
         self.fraction_of_articles_to_use = fraction_of_articles_to_use
         
         self.min_tokens_per_block = min_tokens_per_block  # for the text splitter
@@ -85,73 +175,59 @@ class Dataset:
         Returns:
             Tuple[str]: a tuple containing the title, author, date, URL, tags, and text of the article.
         """
-        title: str = ""
-        author: str = ""
-        date_published: str = None
-        url: str = None
-        tags: str = None
-        text: str = None
-        
         # Get title
-        if 'title' in article and 'book_title' in article and article['title']: title = article['title']
-        elif 'book_title' in article and 'title' not in article and article['book_title']: 
-            title = article['book_title']
-        elif 'title' in article and article['title']: 
-            title = article['title']
+        title = first_present(article, TITLE_KEYS) or ""
         title = title.strip('\n').replace('\n', ' ')[:100]
 
         # Get author
-        if 'author' in article and 'authors' in article and article['author']: author = article['author']
-        elif 'authors' in article and article['authors']: author = article['authors']
-        elif 'author' in article and article['author']: author = article['author']
+        author = first_present(article, AUTHOR_KEYS) or ""
         if type(author) == str: author = get_authors_list(author)
         if type(author) == list: author = ', '.join(author)
         author = author.strip('\n').replace('\n', ' ')[:100]
 
         # Get date published
-        if 'date_published' in article and article['date_published'] and len(article['date_published']) >= 10: date_published = article['date_published'][:10]
-        elif 'published' in article and article['published'] and len(article['published']) >= 16: date_published = article['published'][:16]
-        else: date_published = None
-        if date_published is not None:
-            date_published = standardize_date(date_published)
+        date_published = None
+        for key, length in DATE_KEYS:
+            value = article.get(key)
+            if value and len(value) >= length:
+                date_published = standardize_date(value[:length])
+                break
             
         # Get URL
-        if 'link' in article and article['link']: url = article['link']
-        elif 'url' in article and article['url']: url = article['url']
-        elif 'doi' in article and article['doi']: url = article['doi']
-        else: url = None
+        url = first_present(article, URL_KEYS)
             
         # Get tags
-        if 'tags' in article and article['tags']:
-            if type(article['tags']) == list: tags = ', '.join([val['term'] for val in article['tags']])
-            elif type(article['tags']) == str: tags = article['tags']
-            else: tags = None
+        tags = article.get('tags') or None
+        if type(tags) == list: tags = ', '.join([val['term'] for val in tags])
+        elif type(tags) != str: tags = None
         
         # Get text
-        if 'text' in article and article['text']: text = article['text']
-        else:
+        text = article.get('text')
+        if not text:
             raise MissingDataException(f"Entry has no text.")
 
         return (title, author, date_published, url, tags, text)
            
-    def get_alignment_texts(self):
+    def iter_blocks(self) -> Iterator[Tuple[int, str, Tuple[str]]]:
+        """
+        Streams the dataset: reads the .jsonl one entry at a time, filters and splits each article, and yields its
+        blocks as they are produced, so the corpus never has to be held in memory. Article, block and word counts
+        are updated as a side effect.
+
+        Yields:
+            Tuple[int, str, Tuple[str]]: the block's index, its text, and the (title, author, date, URL, tags) of its article.
+        """
         text_splitter = TokenSplitter(self.min_tokens_per_block, self.max_tokens_per_block)
+        articles_per_split_batch = 64
+        pending_articles = []
         with jsonlines.open(self.jsonl_data_path, "r") as reader:
             for entry in tqdm(reader):
                 try:
                     if 'source' not in entry: 
-                        if 'url' in entry and entry['url'] == "https://www.cold-takes.com/": 
-                            entry["source"] = "Cold Takes"
-                        elif 'question' in entry and 'answer' in entry: 
-                            entry["source"] = "printouts"
-                            continue # for now, skip printouts
-                        elif 'article_url' in entry and entry['article_url'] == "https://www.gwern.net":
-                            entry["source"] = "gwern.net"
-                        elif 'url' in entry and entry['url'] == "https://generative.ink/posts/":
-                            entry["source"] = "generative.ink"
-                        elif 'url' in entry and entry['url'][:24] == "https://greaterwrong.com":
-                            entry["source"] = "greaterwrong.com"
-                        else:
+                        if 'question' in entry and 'answer' in entry: 
+                            continue # printouts; for now, skip them
+                        entry["source"] = source_from_url(entry)
+                        if entry["source"] is None:
                             raise MissingDataException("Entry has no source.")
                     
                     # if we specified custom sources, only include articles from those sources
@@ -166,42 +242,8 @@ class Dataset:
                     elif entry["source"] == 'arxiv':
                         if 'citation_level' != '0': continue
 
-                    # Dict describing the proportion of each source we want:
-                    # E.g.: {'arxiv': 0.5, 'youtube': 0.5, 'lesswrong': 1.0}
-                    desired_source_proportions = {
-                        "https://aipulse.org": 1,
-                        "ebook": 0,
-                        "https://qualiacomputing.com": 0.02,
-                        "alignment forum": .7,
-                        "lesswrong": .5,
-                        "manual": 1,
-                        "arxiv": 0.1,
-                        "https://deepmindsafetyresearch.medium.com/": 1,
-                        "waitbutwhy.com": 1,
-                        "GitHub": 1,
-                        "https://aiimpacts.org": 0.2,
-                        "arbital.com": 0.2,
-                        "carado.moe": 0.3,
-                        "nonarxiv_papers": 0.1,
-                        "https://vkrakovna.wordpress.com": .5,
-                        "https://jsteinhardt.wordpress.com": .5,
-                        "audio-transcripts": 0.2,
-                        "https://intelligence.org": .1,
-                        "youtube": 0.07,
-                        "reports": 0.4,
-                        "https://aisafety.camp": 1,
-                        "curriculum": 1,
-                        "https://www.yudkowsky.net": 0.2,
-                        "distill": 1,
-                        "Cold Takes": 0.5,
-                        "printouts": 1,
-                        "gwern.net": 1,
-                        "generative.ink": 1,
-                        "greaterwrong.com": 0.2
-                    }
-                    
                     random_number = random.random()
-                    if random_number > desired_source_proportions[entry['source']]:
+                    if random_number > DESIRED_SOURCE_PROPORTIONS[entry['source']]:
                         continue
                     
                     # if we specified a fraction of articles to use, only use that fraction from the remaining articles
@@ -221,10 +263,6 @@ class Dataset:
                     if len(text) < 500:
                         continue
 
-                    #we're keeping the text so we inc the aticle count
-                    self.articles_count[entry['source']] += 1
-                    self.total_articles_count += 1
-                    
                     # Get signature
                     signature = ""
                     if title: signature += f"Title: {title}, "
@@ -237,71 +275,225 @@ class Dataset:
                     # if signature: signature = signature[:-2]
                     signature = signature.replace("\n", " ")
                     
-                    # Add info to metadata and embedding strings
-                    self.metadata.append((title, author, date_published, url, tags))
-                    blocks = text_splitter.split(text, signature)
-                    self.embedding_strings.extend(blocks)
-                    self.embeddings_metadata_index.extend([self.total_articles_count-1] * len(blocks))
-                    
-                    # Update counts
-                    self.total_char_count += len(text)
-                    self.total_word_count += len(text.split())
-                    self.total_sentence_count += len(split_into_sentences(text))
-                    self.total_block_count += len(blocks)
+                    # Articles are split in batches, so that tokenization can be batched too
+                    pending_articles.append((entry['source'], (title, author, date_published, url, tags), text, signature))
+                    if len(pending_articles) == articles_per_split_batch:
+                        yield from self._split_articles(pending_articles, text_splitter)
+                        pending_articles = []
                     
                 except MissingDataException as e:
                     if str(e) not in error_count_dict:
                         error_count_dict[str(e)] = 0
                     error_count_dict[str(e)] += 1
 
-    def get_embeddings(self):
-        def get_embeddings_at_index(texts: str, batch_idx: int, batch_size: int = 200): # int, np.ndarray
-            embeddings = np.zeros((batch_size, 1536))
-            openai_output = openai.Embedding.create(
-                model=EMBEDDING_MODEL, 
-                input=texts
-            )['data']
-            for i, embedding in enumerate(openai_output):
-                embeddings[i] = embedding['embedding']
-            return batch_idx, embeddings
+        yield from self._split_articles(pending_articles, text_splitter)
+
+    def _split_articles(self, articles: List[Tuple[str, Tuple[str], str, str]], text_splitter: TokenSplitter) -> Iterator[Tuple[int, str, Tuple[str]]]:
+        """Splits a batch of (source, metadata, text, signature) articles into blocks, updating the counts as it goes."""
+        all_blocks = text_splitter.split_batch([text for _, _, text, _ in articles], [signature for _, _, _, signature in articles])
+        for (source, metadata, text, _), blocks in zip(articles, all_blocks):
+            if not blocks:
+                continue
 
-        batch_size = 500
-        rate_limit = 3500 / 60  # Maximum embeddings per second
+            #we're keeping the text so we inc the aticle count
+            self.articles_count[source] += 1
+            self.total_articles_count += 1
 
+            # Update counts
+            self.total_char_count += len(text)
+            self.total_word_count += len(text.split())
+            self.total_sentence_count += sum(1 for _ in SENTENCE_END.finditer(text))
+
+            for block in blocks:
+                self.total_block_count += 1
+                yield self.total_block_count - 1, block, metadata
+
+    def get_alignment_texts(self):
+        """Collects every block, with its article's metadata, in memory. See stream_embeddings for large datasets."""
+        for _, block, metadata in self.iter_blocks():
+            if len(self.metadata) < self.total_articles_count:
+                self.metadata.append(metadata)
+            self.embedding_strings.append(block)
+            self.embeddings_metadata_index.append(self.total_articles_count-1)
+
+    def get_embeddings(self, cache_path: str = PATH_TO_EMBEDDING_CACHE):
+        asyncio.run(self._get_embeddings(cache_path))
+
+    async def _get_embeddings(self, cache_path: str):
+        with diskcache.Cache(cache_path) as cache:
+            async with openai_session():
+                self.embeddings = await self.embed_texts(self.embedding_strings, cache, self.new_rate_limiter())
+
+    def new_rate_limiter(self) -> "RateLimiter":
+        return RateLimiter(self.rate_limit_per_minute, self.tokens_per_minute)
+
+    async def embed_texts(self, texts: List[str], cache: diskcache.Cache, rate_limiter: "RateLimiter") -> np.ndarray:
+        """
+        Embeds texts, taking whatever it can from the on-disk cache and sending the rest to the API.
+
+        Args:
+            texts (List[str]): the texts to embed.
+            cache (diskcache.Cache): the embedding cache, keyed by embedding_cache_key.
+            rate_limiter (RateLimiter): shared by every call in a run, so the rate limits hold across calls too.
+
+        Returns:
+            np.ndarray: a (len(texts), LEN_EMBEDDINGS) array of EMBEDDING_DTYPE.
+        """
         start = time.time()
-        self.embeddings = np.zeros((len(self.embedding_strings), LEN_EMBEDDINGS))
-
-        with concurrent.futures.ThreadPoolExecutor() as executor:
-            futures = [executor.submit(
-                get_embeddings_at_index, 
-                self.embedding_strings[batch_idx:batch_idx+batch_size], 
-                batch_idx,
-                len(self.embedding_strings[batch_idx:batch_idx+batch_size])
-            ) for batch_idx in range(0, len(self.embedding_strings), batch_size)]
-            num_completed = 0
-            for future in concurrent.futures.as_completed(futures):
-                batch_idx, embeddings = future.result()
-                num_completed += embeddings.shape[0]
-                self.embeddings[batch_idx:batch_idx+embeddings.shape[0]] = embeddings
-
-                elapsed_time = time.time() - start
-                expected_time = num_completed / rate_limit
-                sleep_time = max(expected_time - elapsed_time, 0)
-                time.sleep(sleep_time)
-
-                print(f"Completed {num_completed}/{len(self.embedding_strings)} embeddings in {elapsed_time:.2f} seconds.")
+        embeddings = np.zeros((len(texts), LEN_EMBEDDINGS), dtype=EMBEDDING_DTYPE)
+
+        # Identical texts (repeated boilerplate, short articles split the same way) only need embedding once, so
+        # group the rows by content hash.
+        indices_by_key: Dict[str, List[int]] = defaultdict(list)
+        for i, text in enumerate(texts):
+            indices_by_key[embedding_cache_key(text)].append(i)
+
+        # Embeddings are deterministic per (model, text), so anything we've embedded before comes from disk.
+        missing_keys = []
+        for key, indices in indices_by_key.items():
+            cached = cache.get(key)
+            if cached is None:
+                missing_keys.append(key)
+            else:
+                embeddings[indices] = np.frombuffer(cached, dtype=np.float32)
+        print(f"{len(indices_by_key)}/{len(texts)} texts are unique, of which {len(indices_by_key) - len(missing_keys)} were in the cache.")
+
+        num_completed = 0
+
+        def on_batch_done(offset: int, batch_embeddings: np.ndarray):
+            nonlocal num_completed
+            for key, embedding in zip(missing_keys[offset:offset+batch_embeddings.shape[0]], batch_embeddings):
+                embeddings[indices_by_key[key]] = embedding
+                cache.set(key, embedding.astype(np.float32).tobytes())
+            num_completed += batch_embeddings.shape[0]
+
+            elapsed_time = time.time() - start
+            print(f"Completed {num_completed}/{len(missing_keys)} embeddings in {elapsed_time:.2f} seconds.")
+
+        await embed_batches_throttled(
+            batch_texts_by_tokens([texts[indices_by_key[key][0]] for key in missing_keys]),
+            rate_limiter,
+            self.max_concurrent_requests,
+            on_batch_done,
+        )
+
+        return embeddings
+
+    def stream_embeddings(self,
+            embeddings_path: str,  # Where to write the (num_blocks, LEN_EMBEDDINGS) .npy file.
+            metadata_path: str,  # Where to write one jsonl record per block, in the same order.
+            cache_path: str = PATH_TO_EMBEDDING_CACHE,
+            blocks_per_flush: int = 4096,  # Blocks to buffer before embedding them; several API batches run concurrently.
+            estimated_num_blocks: int = 100_000,  # Initial size of the embeddings file. It grows if this is too low.
+        ):
+        """
+        Like get_alignment_texts + get_embeddings + save_embeddings, but streaming: blocks go straight from
+        iter_blocks to the API and then to disk, so peak memory is O(blocks_per_flush) rather than O(corpus).
+
+        Every flush runs on the same event loop, session and rate limiter, so the rate limits hold across flushes.
+        As in save, the normalized copy that the API maps is written at the end.
+        """
+        asyncio.run(self._stream_embeddings(embeddings_path, metadata_path, cache_path, blocks_per_flush, estimated_num_blocks))
+
+    async def _stream_embeddings(self, embeddings_path: str, metadata_path: str, cache_path: str, blocks_per_flush: int, estimated_num_blocks: int):
+        rate_limiter = self.new_rate_limiter()
+        raw_path = embeddings_path + '.tmp'
+        row_bytes = LEN_EMBEDDINGS * np.dtype(EMBEDDING_DTYPE).itemsize
+        capacity = estimated_num_blocks
+        num_written = 0
+        texts: List[str] = []
+
+        async with openai_session():
+            with diskcache.Cache(cache_path) as cache, jsonlines.open(metadata_path, 'w') as writer, open(raw_path, 'w+b') as raw:
+                raw.truncate(capacity * row_bytes)
+                embeddings = np.memmap(raw, dtype=EMBEDDING_DTYPE, mode='r+', shape=(capacity, LEN_EMBEDDINGS))
+
+                async def flush():
+                    nonlocal embeddings, capacity, num_written
+                    if num_written + len(texts) > capacity:
+                        # grow the backing file and remap it; existing rows stay where they are on disk
+                        embeddings.flush()
+                        del embeddings
+                        capacity = max(2 * capacity, num_written + len(texts))
+                        raw.truncate(capacity * row_bytes)
+                        embeddings = np.memmap(raw, dtype=EMBEDDING_DTYPE, mode='r+', shape=(capacity, LEN_EMBEDDINGS))
+                    embeddings[num_written:num_written+len(texts)] = await self.embed_texts(texts, cache, rate_limiter)
+                    num_written += len(texts)
+                    texts.clear()
+
+                for _, block, metadata in self.iter_blocks():
+                    texts.append(block)
+                    writer.write(block_record(metadata, block))
+                    if len(texts) == blocks_per_flush:
+                        await flush()
+                if texts:
+                    await flush()
+
+                embeddings.flush()
+                del embeddings
+
+        # Copy the rows we actually wrote into a proper .npy, a chunk at a time.
+        src = np.memmap(raw_path, dtype=EMBEDDING_DTYPE, mode='r', shape=(num_written, LEN_EMBEDDINGS))
+        dst = np.lib.format.open_memmap(embeddings_path, mode='w+', dtype=EMBEDDING_DTYPE, shape=(num_written, LEN_EMBEDDINGS))
+        for start in range(0, num_written, blocks_per_flush):
+            dst[start:start+blocks_per_flush] = src[start:start+blocks_per_flush]
+        dst.flush()
+        del src, dst
+        os.remove(raw_path)
+
+        save_normalized_embeddings(embeddings_path)
 
     def save_embeddings(self, path: str):
         np.save(path, self.embeddings)
         
     def load_embeddings(self, path: str):
-        self.embeddings = np.load(path)
+        # Normalize once, so cosine similarity is a plain dot product at query time. The normalized copy is saved
+        # next to the original and reused until the original is rewritten.
+        normalized_path = normalized_embeddings_path(path)
+        if not is_up_to_date(normalized_path, path, np.load(path, mmap_mode='r').shape):
+            save_normalized_embeddings(path)
+
+        # Memory-mapped (read-only): rows are paged in from disk as they're used instead of all up front.
+        self.embeddings = np.load(normalized_path, mmap_mode='r')
         
-    def save_class(self, path: str = PATH_TO_DATASET_PKL):
-        # Save the class to a pickle file
-        print(f"Saving class to {path}...")
-        with open(path, 'wb') as f:
-            pickle.dump(self, f)
+    def save_faiss_index(self, path: str, hnsw_neighbors: int = 0):
+        """
+        Builds a FAISS index over the (normalized) embeddings and writes it to disk, for the API's LocalIndex.
+
+        Args:
+            path (str): where to write the index, e.g. "<base>.faiss" for the export at <base>, which is where
+                the API looks for it by default.
+            hnsw_neighbors (int): if > 0, build an approximate IndexHNSWFlat with this many neighbors per node
+                instead of an exact IndexFlatIP. Worth it once the corpus reaches ~10^5 blocks.
+        """
+        import faiss
+
+        embeddings = normalize_embeddings(self.embeddings)
+        if hnsw_neighbors > 0:
+            index = faiss.IndexHNSWFlat(LEN_EMBEDDINGS, hnsw_neighbors, faiss.METRIC_INNER_PRODUCT)
+            index.hnsw.efSearch = 64
+        else:
+            index = faiss.IndexFlatIP(LEN_EMBEDDINGS)
+        index.add(embeddings)
+
+        print(f"Saving FAISS index to {path}...")
+        faiss.write_index(index, path)
+
+    def save(self, base: str = PATH_TO_DATASET_EXPORT):
+        """
+        Saves the embeddings to <base>.npy, their normalized copy (which the API maps) to <base>.normalized.f32.npy,
+        and one jsonl record per block (see block_record) to <base>.meta.jsonl, in the same order. Unlike pickling
+        the whole class, these can be reopened without loading everything into memory; see open_export.
+        """
+        embeddings_path, metadata_path = export_paths(base)
+        print(f"Saving embeddings to {embeddings_path} and metadata to {metadata_path}...")
+        np.save(embeddings_path, self.embeddings)
+        save_normalized_embeddings(embeddings_path)
+        with jsonlines.open(metadata_path, 'w') as writer:
+            writer.write_all(
+                block_record(self.metadata[metadata_index], text)
+                for text, metadata_index in zip(self.embedding_strings, self.embeddings_metadata_index)
+            )
     
     def save_data(self, path: str = PATH_TO_DATASET_DICT_PKL):
         # Save the data to a pickle file
@@ -322,6 +514,309 @@ class Dataset:
             pickle.dump(data, f)
 
 
+def export_paths(base: str) -> Tuple[str, str]:
+    """The embeddings and metadata files of the export at `base`, as written by Dataset.save and stream_embeddings."""
+    # suffixes are appended rather than swapped in, so a dotted base like "data/v1.2" keeps its name
+    return f"{base}.npy", f"{base}.meta.jsonl"
+
+
+def open_export(base: str) -> Tuple[np.ndarray, Iterator[Dict[str, str]]]:
+    """
+    Reopens an export. The embeddings are memory-mapped, so only the rows that are actually read get paged in,
+    and the block records are streamed from disk as they are iterated.
+    """
+    embeddings_path, metadata_path = export_paths(base)
+
+    def iter_records():
+        with jsonlines.open(metadata_path, 'r') as reader:
+            yield from reader
+
+    return np.load(embeddings_path, mmap_mode='r'), iter_records()
+
+
+def block_record(metadata: Tuple[str], text: str) -> Dict[str, str]:
+    """The jsonl record for a single block: its article's metadata plus the block's own text."""
+    title, author, date_published, url, tags = metadata
+    return {"title": title, "author": author, "date": date_published, "url": url, "tags": tags, "text": text}
+
+
+def normalize_embeddings(embeddings: np.ndarray) -> np.ndarray:
+    """Scales each row to unit length. Done in float32, since squaring fp16 values loses too much precision."""
+    embeddings = embeddings.astype(np.float32)
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return embeddings / norms
+
+
+def normalized_embeddings_path(path: str) -> str:
+    """Where the unit-length float32 copy of the embeddings at `path` is kept. The API memory-maps this file as is."""
+    return f"{str(path).removesuffix('.npy')}.normalized.f32.npy"
+
+
+def save_normalized_embeddings(path: str, rows_per_chunk: int = 65_536):
+    """
+    Writes the unit-length float32 copy of the .npy at `path` to normalized_embeddings_path(path), a chunk of rows
+    at a time, so the whole matrix is never in memory. Written to a temporary file and then renamed, so a reader
+    never maps a half-written copy.
+    """
+    embeddings = np.load(path, mmap_mode='r')
+    normalized_path = normalized_embeddings_path(path)
+    tmp_path = f"{normalized_path}.{os.getpid()}.tmp"
+    normalized = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float32, shape=embeddings.shape)
+    for start in range(0, embeddings.shape[0], rows_per_chunk):
+        normalized[start:start+rows_per_chunk] = normalize_embeddings(embeddings[start:start+rows_per_chunk])
+    normalized.flush()
+    del normalized
+    os.replace(tmp_path, normalized_path)
+
+
+def is_up_to_date(derived_path: str, source_path: str, shape: Tuple[int, ...]) -> bool:
+    """
+    Whether the .npy at derived_path was written from the current contents of source_path: it must be at least as
+    new as the source and have the expected shape, so a copy left over from an earlier dataset isn't reused.
+    """
+    if not os.path.exists(derived_path) or os.stat(derived_path).st_mtime_ns < os.stat(source_path).st_mtime_ns:
+        return False
+    try:
+        return np.load(derived_path, mmap_mode='r').shape == tuple(shape)
+    except ValueError:  # truncated or otherwise unreadable
+        return False
+
+
+def embedding_cache_key(text: str) -> str:
+    """Key for a text's embedding in the on-disk cache. Includes the model, since embeddings differ between models."""
+    return hashlib.blake2b(f"{EMBEDDING_MODEL}\0{text}".encode(), digest_size=16).hexdigest()
+
+
+def batch_texts_by_tokens(
+        texts: List[str],
+        max_texts: int = MAX_TEXTS_PER_EMBEDDING_BATCH,
+        max_tokens: int = MAX_TOKENS_PER_EMBEDDING_BATCH,
+    ) -> Iterator[Tuple[int, List[str], int]]:
+    """
+    Greedily packs consecutive texts into batches for the embeddings endpoint.
+
+    Args:
+        texts (List[str]): the texts to embed, in order.
+        max_texts (int): maximum number of texts per batch.
+        max_tokens (int): maximum summed token count per batch.
+
+    Yields:
+        Tuple[int, List[str], int]: the offset of the batch's first text in `texts`, the batch itself, and its token count.
+    """
+    # one batched call, which tiktoken spreads over threads, rather than a Python call per text
+    token_counts = [len(tokens) for tokens in ENCODER.encode_ordinary_batch(texts, num_threads=os.cpu_count() or 1)]
+
+    offset = 0
+    batch: List[str] = []
+    batch_tokens = 0
+    for i, (text, num_tokens) in enumerate(zip(texts, token_counts)):
+        assert num_tokens <= MAX_TOKENS_PER_EMBEDDING_INPUT, f"text at index {i} is too long to embed ({num_tokens} tokens)"
+        if batch and (len(batch) == max_texts or batch_tokens + num_tokens > max_tokens):
+            yield offset, batch, batch_tokens
+            offset, batch, batch_tokens = i, [], 0
+        batch.append(text)
+        batch_tokens += num_tokens
+    if batch:
+        yield offset, batch, batch_tokens
+
+
+async def get_embedding_batch(texts: List[str]) -> np.ndarray:
+    """Embeds a batch of texts in one request. Returns a (len(texts), LEN_EMBEDDINGS) array."""
+    openai_output = (await openai.Embedding.acreate(model=EMBEDDING_MODEL, input=texts))['data']
+    embeddings = np.zeros((len(texts), LEN_EMBEDDINGS), dtype=np.float32)
+    for embedding in openai_output:
+        embeddings[embedding['index']] = embedding['embedding']
+    return embeddings
+
+
+class RateLimiter:
+    """
+    Request and token buckets for the embeddings endpoint, following the OpenAI cookbook's
+    api_request_parallel_processor.py. The buckets refill continuously at rate_limit_per_minute/60 requests and
+    tokens_per_minute/60 tokens per second, and a request is only sent once both can cover it, so we run close to
+    the quota ceiling without bursting into 429s.
+
+    One RateLimiter should be shared by every request in a run: a fresh one starts with full buckets, so creating
+    one per call would let each call burst a full minute's quota.
+    """
+
+    def __init__(self, rate_limit_per_minute: int, tokens_per_minute: int):
+        self.rate_limit_per_minute = rate_limit_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.available_request_capacity = float(rate_limit_per_minute)
+        self.available_token_capacity = float(tokens_per_minute)
+        self.last_update_time = time.monotonic()
+        self.last_rate_limit_error_time = -float('inf')
+
+    async def acquire(self, num_tokens: int):
+        """Waits until both buckets can cover a request of num_tokens tokens, then takes that capacity."""
+        # a request bigger than the whole bucket would wait forever, so only ask for a full bucket
+        num_tokens = min(num_tokens, self.tokens_per_minute)
+        while True:
+            now = time.monotonic()
+            elapsed = now - self.last_update_time
+            self.last_update_time = now
+            self.available_request_capacity = min(self.available_request_capacity + self.rate_limit_per_minute * elapsed / 60, self.rate_limit_per_minute)
+            self.available_token_capacity = min(self.available_token_capacity + self.tokens_per_minute * elapsed / 60, self.tokens_per_minute)
+
+            pause = self.last_rate_limit_error_time + SECONDS_TO_PAUSE_AFTER_RATE_LIMIT_ERROR - now
+            if pause > 0:
+                await asyncio.sleep(pause)
+                continue
+
+            if self.available_request_capacity >= 1 and self.available_token_capacity >= num_tokens:
+                self.available_request_capacity -= 1
+                self.available_token_capacity -= num_tokens
+                return
+
+            # sleep just long enough for both buckets to cover this request
+            await asyncio.sleep(max(
+                (1 - self.available_request_capacity) * 60 / self.rate_limit_per_minute,
+                (num_tokens - self.available_token_capacity) * 60 / self.tokens_per_minute,
+                0.001,
+            ))
+
+    def on_rate_limit_error(self):
+        """Holds off every request for SECONDS_TO_PAUSE_AFTER_RATE_LIMIT_ERROR, so the quota can recover."""
+        self.last_rate_limit_error_time = time.monotonic()
+
+
+@contextlib.asynccontextmanager
+async def openai_session():
+    """
+    Sends every openai-python request made in this block, including from tasks started in it, through one
+    aiohttp session, so connections are reused rather than opened per request.
+    """
+    async with aiohttp.ClientSession() as session:
+        # openai-python reads the session from a context variable, which tasks inherit
+        token = openai.aiosession.set(session)
+        try:
+            yield
+        finally:
+            openai.aiosession.reset(token)
+
+
+async def embed_batches_throttled(
+        batches: Iterator[Tuple[int, List[str], int]],
+        rate_limiter: RateLimiter,
+        max_concurrent_requests: int,
+        on_batch_done: Callable[[int, np.ndarray], None],
+    ):
+    """
+    Embeds batches concurrently, sending each one once rate_limiter can cover it.
+
+    As in the OpenAI cookbook's api_request_parallel_processor.py, a batch that fails with a transient error (see
+    is_transient_embedding_error) is put back in a retry queue, which is drained before any new batch, so a retry
+    waits for (and spends) capacity like any other request rather than bypassing the rate limiter. On any other
+    error, or once a batch runs out of attempts, no more batches are sent: the requests in flight are cancelled
+    and the error is raised.
+
+    Requests are made with openai-python's async client, so this should run inside openai_session: holding many
+    of them open then costs a pooled socket each rather than a thread each.
+
+    Args:
+        batches: (offset, texts, num_tokens) tuples, as yielded by batch_texts_by_tokens.
+        rate_limiter (RateLimiter): the request and token buckets.
+        max_concurrent_requests (int): maximum number of requests in flight at once.
+        on_batch_done: called with (offset, embeddings) as each batch completes.
+    """
+    semaphore = asyncio.Semaphore(max_concurrent_requests)
+    retry_queue: asyncio.Queue = asyncio.Queue()
+    batches = iter(batches)
+    in_flight = set()
+    failure: Optional[Exception] = None
+
+    async def embed_batch(offset: int, texts: List[str], num_tokens: int, attempts_left: int):
+        nonlocal failure
+        try:
+            embeddings = await get_embedding_batch(texts)
+        except Exception as e:
+            if isinstance(e, openai.error.RateLimitError):
+                rate_limiter.on_rate_limit_error()
+            if attempts_left == 0 or not is_transient_embedding_error(e):
+                # stop the dispatch loop now, rather than after every other batch has been sent
+                if failure is None:
+                    failure = e
+                    dispatcher.cancel()
+                return
+            print(f"Embedding the batch at offset {offset} failed ({e!r}); {attempts_left} attempts left.")
+            retry_queue.put_nowait((offset, texts, num_tokens, attempts_left - 1))
+        else:
+            on_batch_done(offset, embeddings)
+        finally:
+            semaphore.release()
+
+    async def dispatch():
+        while True:
+            # take a request slot before any rate limit capacity, so capacity isn't spent while we wait for one
+            await semaphore.acquire()
+
+            if not retry_queue.empty():
+                offset, texts, num_tokens, attempts_left = retry_queue.get_nowait()
+            else:
+                batch = next(batches, None)
+                if batch is None:
+                    semaphore.release()
+                    if not in_flight:
+                        return
+                    # nothing left to send unless a request in flight fails and is requeued
+                    await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+                    continue
+                offset, texts, num_tokens = batch
+                attempts_left = MAX_ATTEMPTS_PER_EMBEDDING_BATCH - 1
+
+            await rate_limiter.acquire(num_tokens)
+
+            task = asyncio.create_task(embed_batch(offset, texts, num_tokens, attempts_left))
+            in_flight.add(task)
+            task.add_done_callback(in_flight.discard)
+
+    dispatcher = asyncio.create_task(dispatch())
+    try:
+        await dispatcher
+    except asyncio.CancelledError:
+        if failure is None:
+            raise  # cancelled from outside, not by a failed batch
+    finally:
+        for task in in_flight:
+            task.cancel()
+        await asyncio.gather(*in_flight, return_exceptions=True)
+
+    if failure is not None:
+        raise failure
+
+
+def is_transient_embedding_error(e: Exception) -> bool:
+    """Whether a failed embedding request is worth retrying: rate limits, timeouts, connection and 5xx errors."""
+    if isinstance(e, TRANSIENT_EMBEDDING_ERRORS):
+        return True
+    return isinstance(e, openai.error.APIError) and e.http_status is not None and e.http_status >= 500
+
+
+def source_from_url(entry: Dict[str, Any]) -> Optional[str]:
+    """Works out the source of an entry that has no 'source' field from its URL, or returns None if we can't."""
+    for key in ('url', 'article_url'):
+        url = entry.get(key)
+        if not url:
+            continue
+        source = EXACT_URL_TO_SOURCE.get(url)
+        if source is None:
+            source = next((source for prefix, source in PREFIX_URL_TO_SOURCE if url.startswith(prefix)), None)
+        if source is not None:
+            return source
+    return None
+
+
+def first_present(article: Dict[str, Any], keys: Tuple[str]) -> Any:
+    """Returns the value of the first of `keys` that is set (and non-empty) in `article`, or None."""
+    for key in keys:
+        value = article.get(key)
+        if value:
+            return value
+    return None
+
+
 def get_authors_list(authors_string: str) -> List[str]:
     """
     Given a string of authors, return a list of the authors, even if the string contains a single author.
@@ -395,7 +890,7 @@ if __name__ == "__main__":
     dataset.get_embeddings()
     # dataset.save_embeddings("data/embeddings.npy")
     
-    dataset.save_class(PATH_TO_DATASET.resolve())
+    dataset.save(PATH_TO_DATASET_EXPORT)
     # # dataset = pickle.load(open("dataset.pkl", "rb"))
     """
     
\ No newline at end of file
@@ -1,5 +1,7 @@
 import re
-from typing import List
+import os
+import functools
+from typing import List, Tuple
 import tiktoken
 
 import re
@@ -14,6 +16,12 @@ nltk.download("punkt")
 
 
 
+@functools.lru_cache()
+def get_encoding(name: str = "cl100k_base") -> tiktoken.Encoding:
+    """Returns a shared tiktoken encoding, so it is only constructed once per process."""
+    return tiktoken.get_encoding(name)
+
+
 def split_into_sentences(text: str) -> List[str]:
     """
     Splits the input text into sentences.
@@ -31,81 +39,103 @@ class TokenSplitter:
     """Splits text into blocks of tokens according to chatgpt's tokenizer."""
 
     def __init__(self, min_tokens: int = 200, max_tokens: int = 300):
-        self.encoding = tiktoken.get_encoding("cl100k_base")
+        self.encoding = get_encoding()
         self.min_tokens = min_tokens
         self.max_tokens = max_tokens
         self.default_signature = "{url, title, author} unknown"
+        self.paragraph_break = self.encoding.encode_ordinary("\n\n")
+
+    def _text_splitter(self, paragraphs: List[List[Tuple[str, List[int]]]], signature_len: int) -> List[str]:
+        """
+        Splits pre-tokenized text into blocks of tokens according to chatgpt's tokenizer.
+
+        Each paragraph is a list of (sentence, tokens of " " + sentence) pairs. Block lengths are the sums of their
+        sentences' token counts, so nothing is re-encoded while a block grows.
 
-    def _text_splitter(self, text: str, signature: str) -> List[str]:
-        """Splits text into blocks of tokens according to chatgpt's tokenizer."""
-        # enc = self.encoding.encode  # takes a string and returns a list of ints (tokens)
-        enc = self.encoding.encode_ordinary  # takes a string and returns a list of ints (tokens)
+        A sum can differ by a token or so from encoding the joined block (which is what this splitter used to do),
+        and empty blocks are dropped, so block boundaries differ from those of datasets built before batching. Don't
+        mix blocks or embeddings from such datasets with new ones; regenerate them instead.
+        """
         dec = self.encoding.decode  # takes a list of ints (tokens) and returns a string
-        tok_len = lambda x: len(enc(x))  # length of a string in tokens
 
-        max_tokens = self.max_tokens - tok_len(signature) - 10  # 10 to be safe
+        max_tokens = self.max_tokens - signature_len - 10  # 10 to be safe
         assert max_tokens > 0, "max_tokens is too small for the signature"
 
-        min_tokens = self.min_tokens - tok_len(signature) - 10  # 10 to be safe
+        min_tokens = self.min_tokens - signature_len - 10  # 10 to be safe
         assert min_tokens > 0, "min_tokens is too small for the signature"
 
-        blocks = []
+        blocks: List[Tuple[str, List[int]]] = []
         current_block = ""
-        paragraphs = text.split("\n\n")
+        current_tokens: List[int] = []
         
-        for paragraph in paragraphs:
-            sentences = split_into_sentences(paragraph)
+        for sentences in paragraphs:
             if current_block != "":
                 current_block += "\n\n"
+                current_tokens = current_tokens + self.paragraph_break
 
-            for sentence in sentences:
-                potential_new_block = f"{current_block} {sentence}"
-                
-                if tok_len(potential_new_block) <= max_tokens:
-                    current_block = potential_new_block
+            for sentence, tokens in sentences:
+                if len(current_tokens) + len(tokens) <= max_tokens:
+                    current_block = f"{current_block} {sentence}"
+                    current_tokens = current_tokens + tokens
                 
                 else:
-                    blocks.append(current_block)
-                    if tok_len(sentence) < max_tokens:
+                    blocks.append((current_block, current_tokens))
+                    if len(tokens) < max_tokens:
                         current_block = sentence
+                        current_tokens = tokens
                     else:
-                        blocks.append(dec(enc(sentence)[:max_tokens]))
+                        blocks.append((dec(tokens[:max_tokens]), tokens[:max_tokens]))
                         current_block = ""
+                        current_tokens = []
             
-            if tok_len(current_block) > min_tokens:
-                blocks.append(current_block)
+            if len(current_tokens) > min_tokens:
+                blocks.append((current_block, current_tokens))
                 current_block = ""
+                current_tokens = []
 
         if current_block != "":
             if len(blocks) == 0:
-                blocks.append(current_block)
+                blocks.append((current_block, current_tokens))
             else:
-                latest_block = blocks[-1]
-                len_cur_block = tok_len(current_block)
-                latest_plus_current = latest_block + current_block
+                _, latest_tokens = blocks[-1]
 
-                if len_cur_block > min_tokens:
-                    blocks.append(current_block)
+                if len(current_tokens) > min_tokens:
+                    blocks.append((current_block, current_tokens))
                 
                 else:
                     # select the last self.max_tokens tokens from the latest block
-                    last_block = dec(enc(latest_plus_current)[-max_tokens:])
-                    blocks.append(last_block)
+                    last_tokens = (latest_tokens + current_tokens)[-max_tokens:]
+                    blocks.append((dec(last_tokens), last_tokens))
 
-        return [block.strip() for block in blocks]
+        blocks = [block.strip() for block, _ in blocks]
+        return [block for block in blocks if block != ""]
 
     def split(self, text: str, signature: str = None) -> List[str]:
-        if signature is None:
-            signature = self.default_signature
+        return self.split_batch([text], [signature])[0]
+
+    def split_batch(self, texts: List[str], signatures: List[str]) -> List[List[str]]:
+        """
+        Splits several texts at once. Every sentence and signature across the batch is tokenized in a single
+        encode_ordinary_batch call, which runs on multiple threads in tiktoken's Rust core.
+        """
+        signatures = [self.default_signature if signature is None else signature for signature in signatures]
+
+        # Sentences are encoded with the space they're joined with, so their token counts add up.
+        texts_sentences = [[split_into_sentences(paragraph) for paragraph in text.split("\n\n")] for text in texts]
+        to_encode = signatures + [f" {sentence}" for paragraphs in texts_sentences for sentences in paragraphs for sentence in sentences]
+        encoded = self.encoding.encode_ordinary_batch(to_encode, num_threads=os.cpu_count() or 1)
+
+        signature_tokens, sentence_tokens = encoded[:len(signatures)], iter(encoded[len(signatures):])
 
-        blocks = self._text_splitter(text, signature)
+        output = []
+        for paragraphs, signature, tokens in zip(texts_sentences, signatures, signature_tokens):
+            encoded_paragraphs = [[(sentence, next(sentence_tokens)) for sentence in sentences] for sentences in paragraphs]
+            blocks = self._text_splitter(encoded_paragraphs, len(tokens))
 
-        # Check all block elements are strings
-        assert all([isinstance(block, str) for block in blocks]), "block elements are not strings"
+            # Check all block elements are strings
+            assert all([isinstance(block, str) for block in blocks]), "block elements are not strings"
 
-        output = [f'"{block}"\n- {signature}' for block in blocks]
-        # Check all output elements are strings
-        assert all([isinstance(block, str) for block in output]), "output elements are not strings"
+            output.append([f'"{block}"\n- {signature}' for block in blocks])
 
         return output
 
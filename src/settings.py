@@ -9,4 +9,6 @@ MAX_LEN_PROMPT = 4095 # This may be 8191, unsure.
 current_file_path = Path(__file__).resolve()
 PATH_TO_RAW_DATA = str(current_file_path.parent / 'dataset' / 'data' / 'alignment_texts.jsonl')
 PATH_TO_DATASET_PKL = str(current_file_path.parent / 'dataset' / 'data' / 'dataset.pkl')
-PATH_TO_DATASET_DICT_PKL = str(current_file_path.parent / 'dataset' / 'data' / 'dataset_dict.pkl')
\ No newline at end of file
+PATH_TO_DATASET_DICT_PKL = str(current_file_path.parent / 'dataset' / 'data' / 'dataset_dict.pkl')
+PATH_TO_EMBEDDING_CACHE = str(current_file_path.parent / 'dataset' / 'data' / 'emb_cache')
+PATH_TO_DATASET_EXPORT = str(current_file_path.parent / 'dataset' / 'data' / 'dataset')
\ No newline at end of file